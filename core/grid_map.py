@@ -5,9 +5,80 @@ import numpy as np
 import os
 import utils
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+try:
+    import numba
+except ImportError:
+    numba = None
 plt.ion()
 
 
+def _FuseSdfKernel(sdf_map, freq_map, world_pts, r0, c0, T_c_w, scan, scan_valid_idxs, scan_local_xys, normals,
+                   use_plane, min_angle, max_angle, inc_angle, num_scan, min_range, max_range, truncation, eps,
+                   sdf_scale, sdf_quant_max, freq_max, valid_idxs, depth_diff, scan_pts_idxs):
+    """
+    Per-cell counterpart of GridMap._CalcSdfUpdate followed by GridMap._UpdateSdfMap over a window of
+    the map, each cell is handled by exactly one thread.
+    input:
+      world_pts - grid cells center coordinates in meters of shape (2, size_y, size_x)
+      r0, c0 - upper left cell of the window
+    output (in the window, filled in place):
+      valid_idxs, depth_diff - updated cells and their depth differences
+      scan_pts_idxs - flattened scan beam indexes of the cells
+    """
+    win_size_y, win_size_x = valid_idxs.shape
+    scan_center_angle = (max_angle + min_angle) / 2
+    scan_half_fov = (max_angle - min_angle) / 2
+    for i in numba.prange(win_size_y):
+        r = r0 + i
+        for j in range(win_size_x):
+            c = c0 + j
+            # Grid point coordinates in robot frame
+            x_w = world_pts[0, r, c]
+            y_w = world_pts[1, r, c]
+            x = T_c_w[0, 0] * x_w + T_c_w[0, 1] * y_w + T_c_w[0, 2]
+            y = T_c_w[1, 0] * x_w + T_c_w[1, 1] * y_w + T_c_w[1, 2]
+            dist2 = x * x + y * y
+            angle = math.atan2(y, x)
+            idx = int((angle - min_angle) / inc_angle + 0.5)
+            valid = abs(angle - scan_center_angle) <= scan_half_fov and \
+                min_range * min_range <= dist2 <= max_range * max_range and 0 < idx < num_scan
+            idx = min(max(idx, 0), num_scan - 1)
+            scan_pts_idxs[i * win_size_x + j] = idx
+
+            # Calculate point-to-plane or point-to-point distance
+            if use_plane:
+                dx = scan_local_xys[0, idx] - x
+                dy = scan_local_xys[1, idx] - y
+                diff = abs(normals[idx, 0] * dx + normals[idx, 1] * dy)
+                if dx < 0:
+                    diff = -diff
+                elif dx == 0:
+                    diff = 0.0
+            else:
+                diff = scan[idx] - math.sqrt(dist2)
+            depth_diff[i, j] = diff
+
+            # Truncate
+            valid = valid and -truncation/2 + eps < diff < truncation - eps and scan_valid_idxs[idx]
+            valid_idxs[i, j] = valid
+            if not valid:
+                continue
+            # Running average
+            freq = float(freq_map[r, c])
+            sdf = (sdf_map[r, c] * sdf_scale * freq + diff) / (freq + 1)
+            sdf_map[r, c] = min(max(round(sdf / sdf_scale), -sdf_quant_max), sdf_quant_max)
+            if freq_map[r, c] < freq_max:
+                freq_map[r, c] += 1
+
+
+if numba is not None:
+    _FuseSdfKernel = numba.njit(parallel=True, fastmath=True, cache=True)(_FuseSdfKernel)
+
+
 class GridMap(object):
     kEps = 1e-6  # Truncation numerical error
     kNormalWindow = 4  # The left/right neighboring of the beam hit point
@@ -15,13 +86,15 @@ class GridMap(object):
     kNormalDistThr = 0.1
     kTruncationThr = 9
     kIsoMapThr = 0.024
+    kSdfQuantMax = 32767  # Sdf map is stored in int16 fixed point
+    kFreqMax = 65535  # Visit frequency saturates at uint16 maximum
 
     def __init__(self, config_file, num_semantic_classes=4):
         if not os.path.exists(config_file):
             raise RuntimeError("File {} not found.".format(config_file))
 
         with open(config_file, 'r') as fp:
-            cfg = yaml.load(fp)
+            cfg = yaml.load(fp, Loader=YamlLoader)
             self._map_name = cfg['name']
             # Width, height and resolution in meters
             self._width = cfg['width'] + 1.0
@@ -41,20 +114,33 @@ class GridMap(object):
         self._grid_ul_coord = np.array(
             [self._mini_x, self._maxi_y], dtype=np.float32)
 
+        # Grid cells center coordinates in meters (in xy fashion), of shape (2, N)
+        ys, xs = np.meshgrid(np.arange(self._size_y, dtype=np.int32), np.arange(self._size_x, dtype=np.int32),
+                             indexing='ij')
+        self._world_pts = (np.stack((xs.ravel(), -ys.ravel())).astype(np.float32) * self._res +
+                           self._grid_ul_coord.reshape(-1, 1) +
+                           np.array([self._res/2, -self._res/2], dtype=np.float32).reshape(-1, 1))
+
         # Threshold of front and back truncation (in meters)
         self._truncation = self.kTruncationThr * self._res
+        # Sdf values are bounded by the truncation, meters per quantization step
+        self._sdf_scale = self._truncation / self.kSdfQuantMax
         # Construct sdf map
-        self._sdf_map = np.full([self._size_y, self._size_x], self._truncation)
+        self._sdf_map = np.full([self._size_y, self._size_x], self.kSdfQuantMax, dtype=np.int16)
         # Construct visit frequency map
-        self._freq_map = np.zeros([self._size_y, self._size_x])
+        self._freq_map = np.zeros([self._size_y, self._size_x], dtype=np.uint16)
+        # Sdf map gradients, computed on demand
+        self._sdf_grad_maps = None
         # Only for test
         self._occupancy_map = np.zeros(
             [self._size_y, self._size_x], np.float32)
+        # Figures and image handles reused across visualization calls
+        self._figures = {}
 
         # Semantics
         self._num_semantic_classes = num_semantic_classes
         self._sdf_map_semantic = np.full([self._size_y, self._size_x, num_semantic_classes],
-                                         self._truncation)
+                                         self._truncation, dtype=np.float32)
         self._freq_map_semantic = np.full(
             [self._size_y, self._size_x, num_semantic_classes], 0)
 
@@ -69,14 +155,45 @@ class GridMap(object):
         if save_path is not None:
             plt.savefig(save_path)
 
+    def _ShowGrid(self, name, grid, save_path=None):
+        """
+        Draw grid into the figure kept under name, instead of opening a new blocking figure on every call.
+        """
+        if name not in self._figures:
+            fig = plt.figure()
+            ax = fig.add_subplot(1, 1, 1)
+            self._figures[name] = (fig, ax.imshow(grid))
+        fig, im = self._figures[name]
+        im.set_data(grid)
+        im.autoscale()
+        fig.canvas.draw_idle()
+        plt.pause(0.001)
+        if save_path is not None:
+            fig.savefig(save_path)
+
     @property
     def sdf_map(self):
-        return self._sdf_map
+        # Decoded to meters
+        return self._sdf_map * np.float32(self._sdf_scale)
 
     @property
     def freq_map(self):
         return self._freq_map
 
+    @property
+    def resolution(self):
+        return self._res
+
+    def GradientMaps(self):
+        """
+        Sdf map gradients in meters (in xy fashion), cached until the next FuseSdf.
+        """
+        if self._sdf_grad_maps is None:
+            grad_rs, grad_cs = np.gradient(self.sdf_map, self._res)
+            # Row index grows downwards while y grows upwards
+            self._sdf_grad_maps = (grad_cs, -grad_rs)
+        return self._sdf_grad_maps
+
     def GetSdfValue(self, r, c):
         return self.InterpolateSdfValue(r, c)
 
@@ -99,10 +216,7 @@ class GridMap(object):
 
         self._occupancy_map[scan_w_ys, scan_w_xs] = 1
 
-        fig = plt.figure()
-        ax = fig.add_subplot(1, 1, 1)
-        plt.imshow(self._occupancy_map)
-        plt.show(block=True)
+        self._ShowGrid('occupancy', self._occupancy_map)
 
     def MapOneScanFromSE2(self, scan, pose):
         """
@@ -118,10 +232,7 @@ class GridMap(object):
 
         occupancy_map[scan_w_ys, scan_w_xs] = 1
 
-        fig = plt.figure()
-        ax = fig.add_subplot(1, 1, 1)
-        plt.imshow(occupancy_map)
-        plt.show(block=True)
+        self._ShowGrid('scan', occupancy_map)
 
     def MapOneScanFromSE2WithSemantic(self, scan, pose, semantic_labels):
         """
@@ -138,10 +249,7 @@ class GridMap(object):
 
         occupancy_map[scan_w_ys, scan_w_xs] = semantic_labels
 
-        fig = plt.figure()
-        ax = fig.add_subplot(1, 1, 1)
-        plt.imshow(occupancy_map)
-        plt.show(block=True)
+        self._ShowGrid('scan_semantic', occupancy_map)
 
     def InterpolateSdfValue(self, r, c):
         # r and c are float numbers, indicating the index of the cell
@@ -159,10 +267,10 @@ class GridMap(object):
                 volume = r_dist * c_dist
                 if self._freq_map[r_curr, c_curr] > 0:
                     if volume < 1e-7:
-                        return self._sdf_map[r_curr, c_curr]
+                        return self._sdf_map[r_curr, c_curr] * self._sdf_scale
                     w = 1.0 / volume
                     w_sum += w
-                    sdf_sum += w * self._sdf_map[r_curr, c_curr]
+                    sdf_sum += w * self._sdf_map[r_curr, c_curr] * self._sdf_scale
         return sdf_sum / w_sum
 
     def InterpolateSdfValueSemantic(self, r, c, cls):
@@ -219,33 +327,70 @@ class GridMap(object):
         - scan: beam depth vector
         - pose: SE2
         """
-        N = self._size_x * self._size_y
-        ys, xs = np.meshgrid(range(self._size_y),
-                             range(self._size_x), indexing='ij')
-        # In xy fashion
-        grid_coords = np.concatenate(
-            (xs.reshape(1, -1), -ys.reshape(1, -1)), axis=0).astype(int)
-
-        # Grid cells coordinates to world coordinates in meters (in xy fashion)
-        world_pts = grid_coords.astype(
-            float) * self._res + self._grid_ul_coord.reshape(-1, 1) + \
-            np.array([self._res/2, -self._res/2]).reshape(-1, 1)
-
-        # World coordinates to camera coordinates transform
-        T_c_w = np.linalg.inv(pose)
-
-        # (2, N), N: total number of grids, grid point coordinates in robot frame
-        grid_local_pts = np.dot(T_c_w[:2, :2], world_pts) + np.tile(
-            T_c_w[:2, 2].reshape(2, 1), (1, world_pts.shape[1]))
-        # grid_local_dist = np.linalg.norm(
-        #     grid_local_pts - np.repeat(trans, grid_local_pts.shape[1], axis=1), axis=0)
-        grid_local_dist = np.linalg.norm(grid_local_pts, axis=0)
-
-        grid_local_pts_tan = [(grid_local_pts[1, i] / grid_local_pts[0, i]) if grid_local_pts[0, i]
-                              != 0 else (math.pi/2 if grid_local_pts[1, i] > 0 else -math.pi/2)
-                              for i in range(grid_local_pts.shape[1])]
+        # Only the cells within the max range around the scan center can be updated
+        center_cs, center_rs = self.FromMeterToCell(pose[:2, 2:3])
+        k = int(np.ceil(max_range / self._res)) + 1
+        r0, r1 = max(int(center_rs[0]) - k, 0), min(int(center_rs[0]) + k + 1, self._size_y)
+        c0, c1 = max(int(center_cs[0]) - k, 0), min(int(center_cs[0]) + k + 1, self._size_x)
+        if r0 >= r1 or c0 >= c1:
+            return
+        window = (slice(r0, r1), slice(c0, c1))
+        win_size_y, win_size_x = r1 - r0, c1 - c0
+
+        # World coordinates to camera coordinates transform, float32 keeps the per-cell math in float32
+        T_c_w = np.linalg.inv(pose).astype(np.float32, copy=False)
+        num_scan = int(np.ceil((max_angle - min_angle) / inc_angle)) + 1
+
+        # Calculate normal vectors of the current scan
+        if use_plane:
+            normals = self.CalcNormalVecOfAScan(
+                scan_valid_idxs, scan_local_xys, scan_dir_vecs)
+        else:
+            normals = np.zeros((1, 2), dtype=np.float32)
+
+        if numba is not None:
+            valid_idxs = np.empty((win_size_y, win_size_x), dtype=np.bool_)
+            depth_diff = np.empty((win_size_y, win_size_x), dtype=np.float32)
+            scan_pts_idxs = np.empty(win_size_y * win_size_x, dtype=np.int32)
+            _FuseSdfKernel(self._sdf_map, self._freq_map, self._world_pts.reshape(2, self._size_y, self._size_x),
+                           r0, c0, T_c_w, scan, scan_valid_idxs, scan_local_xys, normals, use_plane, min_angle,
+                           max_angle, inc_angle, num_scan, min_range, max_range, self._truncation, self.kEps,
+                           self._sdf_scale, self.kSdfQuantMax, self.kFreqMax, valid_idxs, depth_diff,
+                           scan_pts_idxs)
+        else:
+            world_pts = self._world_pts.reshape(2, self._size_y, self._size_x)[:, r0:r1, c0:c1]
+            valid_idxs, depth_diff, scan_pts_idxs = self._CalcSdfUpdate(
+                world_pts.reshape(2, -1), T_c_w, scan, scan_valid_idxs, scan_local_xys, normals, use_plane,
+                min_angle, max_angle, inc_angle, num_scan, min_range, max_range)
+            valid_idxs = np.reshape(valid_idxs, (win_size_y, win_size_x))
+            depth_diff = np.reshape(depth_diff, (win_size_y, win_size_x))
+            self._UpdateSdfMap(valid_idxs, depth_diff, window)
+        self._sdf_grad_maps = None
+
+        if use_semantics:
+            if semantic_labels is None:
+                raise RuntimeError("No semantic label provided.")
+            self._UpdateSdfMapWithSemantics(
+                valid_idxs, depth_diff, scan_pts_idxs, semantic_labels, window)
+
+    def _CalcSdfUpdate(self, world_pts, T_c_w, scan, scan_valid_idxs, scan_local_xys, normals, use_plane,
+                       min_angle, max_angle, inc_angle, num_scan, min_range, max_range):
+        """
+        input:
+        - world_pts: grid cells center coordinates in meters of shape (2, N)
+        - T_c_w: world to camera transform in SE2
+        output:
+        - valid_idxs, depth_diff, scan_pts_idxs: of shape (N,)
+        """
+        N = world_pts.shape[1]
+        # (2, N), N: total number of grids in the window, grid point coordinates in robot frame
+        grid_local_pts = np.dot(T_c_w[:2, :2], world_pts)
+        grid_local_pts += T_c_w[:2, 2:3]
+        # Squared distance is enough for the range check
+        grid_local_dist2 = np.einsum('ij,ij->j', grid_local_pts, grid_local_pts)
+
         # Angle between scan center and the point
-        grid_local_pts_angle = np.arctan(grid_local_pts_tan)
+        grid_local_pts_angle = np.arctan2(grid_local_pts[1], grid_local_pts[0])
 
         # Pick the points inside the view frustum
         """
@@ -256,30 +401,23 @@ class GridMap(object):
                            *  (scan optical center)
         """
         # For each local grid coordinates in robot frame, compute the scan hit index in camera
-        scan_pts_idxs = ((grid_local_pts_angle - min_angle) /
-                         inc_angle + 0.5).astype(np.int16)
-        num_scan = np.ceil((max_angle - min_angle) / inc_angle) + 1
+        scan_pts_idxs = np.subtract(grid_local_pts_angle, np.float32(min_angle))
+        scan_pts_idxs /= np.float32(inc_angle)
+        scan_pts_idxs += np.float32(0.5)
+        scan_pts_idxs = scan_pts_idxs.astype(np.int32)
+        # Angular offset of the point from the scan center
+        scan_center_angle = (max_angle + min_angle) / 2
+        scan_half_fov = (max_angle - min_angle) / 2
         # Get valid grid cell indexes
-        # This positive grid_local_pts[0] check only works when the scan angle covering less than pi!
-        grid_valid_idxs = np.logical_and(np.logical_and(grid_local_pts[0] > 0,
-                                                        np.logical_and(grid_local_dist <= max_range,
-                                                                       grid_local_dist >= min_range)),
-                                         np.logical_and(
-                                             np.logical_and(
-                                                 scan_pts_idxs > 0, scan_pts_idxs < num_scan),
-                                             np.logical_and(grid_local_pts_angle >= min_angle,
-                                                            grid_local_pts_angle <= max_angle)))
+        grid_valid_idxs = np.logical_and(np.logical_and(np.fabs(grid_local_pts_angle - scan_center_angle) <= scan_half_fov,
+                                                        np.logical_and(grid_local_dist2 <= max_range * max_range,
+                                                                       grid_local_dist2 >= min_range * min_range)),
+                                         np.logical_and(scan_pts_idxs > 0, scan_pts_idxs < num_scan))
         # Prepare for validating the indexing (getting rid of too large or too small indexes)
-        scan_pts_idxs[scan_pts_idxs < 0] = 0
-        scan_pts_idxs[scan_pts_idxs >= num_scan] = 0
-
-        # Calculate normal vectors of the current scan
-        if use_plane:
-            normals = self.CalcNormalVecOfAScan(
-                scan_valid_idxs, scan_local_xys, scan_dir_vecs)
+        np.clip(scan_pts_idxs, 0, num_scan - 1, out=scan_pts_idxs)
 
         # Calculate depth update for valid voxels
-        depth_val = np.zeros(N)
+        depth_val = np.zeros(N, dtype=np.float32)
         depth_val[grid_valid_idxs] = scan[scan_pts_idxs[grid_valid_idxs]]
 
         # Calculate point-to-plane or point-to-point distance
@@ -289,9 +427,11 @@ class GridMap(object):
             p2p_dist_sign = np.sign(p2p_dist[0, :])
             # p2p_dist = depth_val - grid_local_dist
             # tmp = scan_dir_vecs[:, scan_pts_idxs] * p2p_dist
+            # Column-wise dot product of the normals and the distances
             depth_diff = np.multiply(p2p_dist_sign, np.fabs(
-                np.dot(normals[scan_pts_idxs], p2p_dist).diagonal()))
+                np.sum(normals[scan_pts_idxs].T * p2p_dist, axis=0)))
         else:
+            grid_local_dist = np.sqrt(grid_local_dist2, out=grid_local_dist2)
             depth_diff = depth_val - grid_local_dist
 
         # Truncate
@@ -299,49 +439,40 @@ class GridMap(object):
                                                depth_diff < self._truncation - self.kEps)
         valid_idxs = np.logical_and(grid_valid_idxs, depth_diff_valid_idxs)
         valid_idxs = np.logical_and(valid_idxs, scan_valid_idxs[scan_pts_idxs])
-
-        valid_idxs = np.reshape(valid_idxs, (self._size_y, self._size_x))
-        depth_diff = np.reshape(depth_diff, (self._size_y, self._size_x))
-
-        self._UpdateSdfMap(valid_idxs, depth_diff)
-
-        if use_semantics:
-            if semantic_labels is None:
-                raise RuntimeError("No semantic label provided.")
-            self._UpdateSdfMapWithSemantics(
-                valid_idxs, depth_diff, scan_pts_idxs, semantic_labels)
-
-    def _UpdateSdfMap(self, idxs, depth_diff):
-        new_freq_map = self._freq_map + 1
-        sdf_map = np.divide(np.multiply(
-            self._sdf_map, self._freq_map) + depth_diff, new_freq_map)
-        self._sdf_map[idxs] = sdf_map[idxs]
-        self._freq_map[idxs] += 1
-
-    def _UpdateSdfMapWithSemantics(self, idxs, depth_diff, scan_pts_idxs, semantic_labels):
-        voxel_labels = semantic_labels[scan_pts_idxs].reshape((self._size_y, self._size_x))
-        # rs, cs = np.ogrid[:self._size_y, :self._size_x]
-        # new_freq_map = self._freq_map_semantic[rs, cs, voxel_labels] + 1
-        # new_sdf_map = np.divide(np.multiply(
-        #     self._sdf_map_semantic[rs, cs, voxel_labels], self._freq_map_semantic[rs, cs, voxel_labels]) + depth_diff, new_freq_map)
-
-        # TODO (shixin): Stupid for-loop, need to substitute with better numpy operation
-        for r in range(self._size_y):
-            for c in range(self._size_x):
-                if idxs[r, c]:
-                    self._sdf_map_semantic[r, c, voxel_labels[r, c]] = float(self._freq_map_semantic[r, c, voxel_labels[r, c]] * \
-                                                                       self._sdf_map_semantic[r, c, voxel_labels[r, c]] + depth_diff[r, c]) / \
-                                                                       (self._freq_map_semantic[r, c, voxel_labels[r, c]] + 1)
-                    self._freq_map_semantic[r, c, voxel_labels[r, c]] = self._freq_map_semantic[r, c, voxel_labels[r, c]] + 1
+        return valid_idxs, depth_diff, scan_pts_idxs
+
+    def _UpdateSdfMap(self, idxs, depth_diff, window):
+        # Running average over the updated cells only
+        sdf_map = self._sdf_map[window]
+        freq_map = self._freq_map[window]
+        freq = freq_map[idxs].astype(np.float32)
+        sdf = sdf_map[idxs] * np.float32(self._sdf_scale)
+        sdf = (sdf * freq + depth_diff[idxs]) / (freq + 1)
+        sdf_map[idxs] = np.clip(np.round(sdf / self._sdf_scale), -self.kSdfQuantMax, self.kSdfQuantMax)
+        freq_map[idxs] = np.minimum(freq + 1, self.kFreqMax)
+
+    def _UpdateSdfMapWithSemantics(self, idxs, depth_diff, scan_pts_idxs, semantic_labels, window):
+        # Only the active cells inside the truncation band are touched, each (r, c) at most once
+        active = np.flatnonzero(idxs)
+        rs, cs = np.unravel_index(active, idxs.shape)
+        voxel_labels = semantic_labels[scan_pts_idxs[active]]
+        sdf_map_semantic = self._sdf_map_semantic[window]
+        freq_map_semantic = self._freq_map_semantic[window]
+
+        freq = freq_map_semantic[rs, cs, voxel_labels]
+        sdf_map_semantic[rs, cs, voxel_labels] = (freq * sdf_map_semantic[rs, cs, voxel_labels] +
+                                                  depth_diff[rs, cs]) / (freq + 1.0)
+        freq_map_semantic[rs, cs, voxel_labels] = freq + 1
 
     def VisualizeSdfMap(self, save_path=None):
-        self._VisualizeOccupancyGrid(self._sdf_map, save_path=save_path)
+        self._ShowGrid('sdf', self.sdf_map, save_path=save_path)
 
     def VisualizeOccMap(self, save_path=None):
         occ_map = np.zeros((self._size_y, self._size_x), dtype=np.float32)
+        sdf_map = self.sdf_map
         for i in range(self._size_y):
             for j in range(self._size_x):
-                if math.fabs(self._sdf_map[i, j]) < self.kIsoMapThr:
+                if math.fabs(sdf_map[i, j]) < self.kIsoMapThr:
                     occ_map[i, j] = 1.0 * np.argmax(self._freq_map_semantic[i, j]) * 50
         self._VisualizeOccupancyGrid(occ_map, save_path=save_path)
 
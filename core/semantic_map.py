@@ -7,6 +7,10 @@ import numpy as np
 import os
 import sys
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 class SemanticMap(object):
@@ -21,7 +25,7 @@ class SemanticMap(object):
             raise RuntimeError("File {} not found.".format(map_fig_file))
 
         with open(config_file, 'r') as fp:
-            cfg = yaml.load(fp)
+            cfg = yaml.load(fp, Loader=YamlLoader)
             self._map_name = cfg['name']
             # Width, height and resolution in meters
             self._width = cfg['width']
@@ -13,6 +13,10 @@ import os
 import sys
 import utils
 import yaml
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from grid_map import GridMap
 from optimizer import SdfOptimizer
@@ -34,6 +38,125 @@ gflags.DEFINE_string("semantic_map_path", "../data/maps/colored_map_1.png",
 gflags.DEFINE_boolean("use_semantics", True, "Whether use semantic labels for optimization.")
 
 
+def _InterpolateSdfValue(sdf_map, freq_map, r, c):
+    # Same as GridMap.InterpolateSdfValue
+    w_sum = 0.0
+    sdf_sum = 0.0
+    for r_offset in (-1, 0, 1):
+        for c_offset in (-1, 0, 1):
+            r_curr = int(r) + r_offset
+            c_curr = int(c) + c_offset
+            # Calculate the coordinate distance (in cells)
+            r_dist = abs(r_curr + 0.5 - r)
+            c_dist = abs(c_curr + 0.5 - c)
+            if r_dist > 1.0 or c_dist > 1.0:
+                continue
+            volume = r_dist * c_dist
+            if freq_map[r_curr, c_curr] > 0:
+                if volume < 1e-7:
+                    return sdf_map[r_curr, c_curr]
+                w = 1.0 / volume
+                w_sum += w
+                sdf_sum += w * sdf_map[r_curr, c_curr]
+    return sdf_sum / w_sum
+
+
+def _AccumulateHessian(sdf_map, freq_map, scan_w, scan_cs, scan_rs, valid_idxs, res, huber_thr):
+    """
+    Gauss-Newton accumulation of Track over all the scan points.
+    input:
+      sdf_map, freq_map - grid map sdf values and visit frequencies
+      scan_w - scan point coordinates in meters in world frame
+      scan_cs, scan_rs - scan point coordinates in cells (no rounding)
+      valid_idxs - valid scan points
+      res - grid map resolution in meters
+      huber_thr - visit frequency at which a cell gets full weight
+    output:
+      H, g, err_sum, opt_num
+    """
+    size_y, size_x = sdf_map.shape
+    H = np.zeros((3, 3))
+    g = np.zeros((3, 1))
+    J = np.zeros(3)
+    err_sum = 0.0
+    opt_num = 0
+    for i in range(scan_cs.shape[0]):
+        if not valid_idxs[i]:
+            continue
+        c = scan_cs[i]
+        r = scan_rs[i]
+        # Same as GridMap.HasValidGradient
+        if r-1 < 0 or c-1 < 0 or r+1 > size_y - 1 or c+1 > size_x - 1:
+            continue
+        if freq_map[int(r-1), int(c)] < 1 or freq_map[int(r+1), int(c)] < 1 or \
+           freq_map[int(r), int(c-1)] < 1 or freq_map[int(r), int(c+1)] < 1:
+            continue
+        opt_num += 1
+        # dD / dx, same as GridMap.CalcSdfGradient
+        g_x = 0.5 * (_InterpolateSdfValue(sdf_map, freq_map, r, c+1.0) -
+                     _InterpolateSdfValue(sdf_map, freq_map, r, c-1.0)) / res
+        g_y = 0.5 * (_InterpolateSdfValue(sdf_map, freq_map, r-1.0, c) -
+                     _InterpolateSdfValue(sdf_map, freq_map, r+1.0, c)) / res
+        # Jacobian J_d_xi = J_d_x * J_x_xi, with J_x_xi = [[1, 0, -y_w], [0, 1, x_w]]
+        J[0] = g_x
+        J[1] = g_y
+        J[2] = -g_x * scan_w[1, i] + g_y * scan_w[0, i]
+        # Gauss-Newton approximation to Hessian
+        freq = freq_map[int(r), int(c)]
+        wt = 1.0 if freq >= huber_thr else freq / huber_thr
+        sdf_val = _InterpolateSdfValue(sdf_map, freq_map, r, c)
+        for p in range(3):
+            for q in range(3):
+                H[p, q] += J[p] * J[q] * wt
+            g[p, 0] += J[p] * sdf_val * wt
+        err_sum += sdf_val * sdf_val
+    return H, g, err_sum, opt_num
+
+
+if numba is not None:
+    _InterpolateSdfValue = numba.njit(cache=True)(_InterpolateSdfValue)
+    _AccumulateHessian = numba.njit(cache=True, fastmath=True)(_AccumulateHessian)
+
+
+def _AccumulateHessianVectorized(sdf_map, freq_map, grad_x_map, grad_y_map, scan_w, scan_cs, scan_rs,
+                                 valid_idxs, huber_thr):
+    """
+    NumPy counterpart of _AccumulateHessian when numba is not available. The sdf values and
+    gradients are taken from the cells the scan points fall in instead of being interpolated.
+    input:
+      grad_x_map, grad_y_map - sdf map gradients in meters (in xy fashion)
+    """
+    size_y, size_x = sdf_map.shape
+    # Check boundary
+    idxs = np.flatnonzero(np.logical_and(valid_idxs, np.logical_and(
+        np.logical_and(scan_rs >= 1, scan_rs <= size_y - 2),
+        np.logical_and(scan_cs >= 1, scan_cs <= size_x - 2))))
+    rs = scan_rs[idxs].astype(int)
+    cs = scan_cs[idxs].astype(int)
+    # Check the neighboring cells are visited, same as GridMap.HasValidGradient
+    has_grad = np.logical_and(np.logical_and(freq_map[rs-1, cs] >= 1, freq_map[rs+1, cs] >= 1),
+                              np.logical_and(freq_map[rs, cs-1] >= 1, freq_map[rs, cs+1] >= 1))
+    idxs, rs, cs = idxs[has_grad], rs[has_grad], cs[has_grad]
+    opt_num = idxs.shape[0]
+    # dD / dx of shape (K, 2)
+    J_d_x = np.stack((grad_x_map[rs, cs], grad_y_map[rs, cs]), axis=1)
+    # dx / d\xi of shape (K, 2, 3)
+    J_x_xi = np.zeros((opt_num, 2, 3), dtype=np.float32)
+    J_x_xi[:, 0, 0] = J_x_xi[:, 1, 1] = 1
+    J_x_xi[:, 0, 2] = -scan_w[1, idxs]
+    J_x_xi[:, 1, 2] = scan_w[0, idxs]
+    # Jacobians J_d_xi of shape (K, 3)
+    J = np.einsum('kd,kdp->kp', J_d_x, J_x_xi)
+    # Gauss-Newton approximation to Hessian
+    wt = np.minimum(freq_map[rs, cs] / huber_thr, 1.0)
+    sdf_vals = sdf_map[rs, cs]
+    # Weighted sums over all the points as single BLAS GEMM / GEMV calls
+    H = np.dot(J.T * wt, J)
+    g = np.dot(J.T, sdf_vals * wt).reshape(3, 1)
+    err_sum = float(np.dot(sdf_vals, sdf_vals))
+    return H, g, err_sum, opt_num
+
+
 class SLAM(object):
     # Some constants
     kDeltaTime = 1
@@ -76,7 +199,10 @@ class SLAM(object):
                                       self._max_angle + self._res_angle,
                                       self._res_angle)
         self._scan_dir_vecs = np.stack(
-            (np.cos(self._scan_angles), np.sin(self._scan_angles)))
+            (np.cos(self._scan_angles), np.sin(self._scan_angles))).astype(np.float32)
+        # Beam depths of all the scans of shape (T, B), and their local xy coordinates of shape (T, 2, B)
+        self._scan_ranges = np.array([s[0] for s in self._scans], dtype=np.float32)
+        self._scan_valid_idxs, self._scan_local_xys = self._ProcessScanToLocalCoords(self._scan_ranges)
 
         # Estimated poses (se2) from SDF tracker
         self._est_poses = []
@@ -96,13 +222,14 @@ class SLAM(object):
         self._max_range = self._scans[0][5]
 
     def _ProcessScanToLocalCoords(self, scan):
+        """
+        input:
+          scan - beam depth vector of shape (B,), or scans stacked of shape (T, B)
+        """
         valid_idxs = np.logical_and((scan > self._min_range),
                                     (scan < self._max_range))
-        angles = self._scan_angles
-        x = scan * np.cos(angles)
-        y = scan * np.sin(angles)
-        z = np.ones(x.shape)
-        ret = np.stack((x, y))
+        # Local xy coordinates of shape (2, B) or (T, 2, B)
+        ret = scan[..., np.newaxis, :] * self._scan_dir_vecs
         return valid_idxs, ret
 
     def Track(self, valid_idxs, scan):
@@ -111,47 +238,25 @@ class SLAM(object):
         it = 0
         # last_pose is a SE2
         last_pose = self._last_pose
-
+        # Decode the maps once, they do not change while tracking
+        sdf_map = self._grid_map.sdf_map
+        freq_map = self._grid_map.freq_map
+        if numba is None:
+            grad_x_map, grad_y_map = self._grid_map.GradientMaps()
+
+        # World scan coordinates
+        scan_w = utils.GetScanWorldCoordsFromSE2(scan, last_pose)
         while it < self.kOptMaxIters:
-            # World scan coordinates
-            scan_w = utils.GetScanWorldCoordsFromSE2(scan, last_pose)
             scan_cs, scan_rs = self._grid_map.FromMeterToCellNoRound(scan_w)
-            # Hessian
-            H = np.zeros((3, 3), dtype=np.float32)
-            g = np.zeros((3, 1), dtype=np.float32)
-            err_sum = 0.0
-
             # Calculate hessian and g term
-            opt_num = 0
-            for i in range(scan_cs.shape[0]):
-                if not valid_idxs[i]:
-                    continue
-                c = scan_cs[i]
-                r = scan_rs[i]
-                # World x and y
-                x_w = scan_w[0, i]
-                y_w = scan_w[1, i]
-                # Local x and y
-                x_l = scan[0, i]
-                y_l = scan[1, i]
-                if self._grid_map.HasValidGradient(r, c):
-                    opt_num += 1
-                    # dD / dx
-                    J_d_x = self._grid_map.CalcSdfGradient(r, c)
-                    # dx / d\xi
-                    J_x_xi = np.zeros((2, 3), dtype=np.float32)
-                    J_x_xi[0, 0] = J_x_xi[1, 1] = 1
-                    J_x_xi[0, 2] = -y_w
-                    J_x_xi[1, 2] = x_w
-                    # Jacobian J_d_xi of shape (1, 3)
-                    J = np.dot(J_d_x, J_x_xi)
-                    # Gauss-Newton approximation to Hessian
-                    freq = float(self._grid_map.freq_map[int(r), int(c)])
-                    wt = 1.0 if freq >= self.kHuberThr else freq / self.kHuberThr
-                    sdf_val = self._grid_map.GetSdfValue(r, c)
-                    H += np.dot(J.transpose(), J) * wt
-                    g += J.transpose() * sdf_val * wt
-                    err_sum += sdf_val * sdf_val
+            if numba is not None:
+                H, g, err_sum, opt_num = _AccumulateHessian(
+                    sdf_map, freq_map, scan_w, scan_cs, scan_rs, valid_idxs,
+                    self._grid_map.resolution, self.kHuberThr)
+            else:
+                H, g, err_sum, opt_num = _AccumulateHessianVectorized(
+                    sdf_map, freq_map, grad_x_map, grad_y_map, scan_w, scan_cs, scan_rs, valid_idxs,
+                    self.kHuberThr)
             logging.info("opt_num: %s", opt_num)
             if opt_num == 0:
                 logging.error("opt_num=0!")
@@ -159,7 +264,7 @@ class SLAM(object):
             err_metric = err_sum / opt_num
             logging.info("   error term: %s ", err_metric)
             try:
-                xi = -np.dot(np.linalg.inv(H), g)
+                xi = -np.linalg.solve(H, g)
             except np.linalg.LinAlgError as err:
                 logging.info("Hessian matrix not invertible.")
                 xi = np.zeros((3, 1), dtype=np.float32)
@@ -168,7 +273,10 @@ class SLAM(object):
             if np.abs(xi[2]) < self.kEpsOfYaw and np.linalg.norm(xi[:2]) < self.kEpsOfTrans or \
                err_metric < self.kOptStopThr:
                 break
-            last_pose = np.dot(utils.ExpFromSe2(xi), last_pose)
+            delta_pose = utils.ExpFromSe2(xi)
+            last_pose = np.dot(delta_pose, last_pose)
+            # Apply the same increment to the world scan instead of transforming it again from robot frame
+            scan_w = utils.GetScanWorldCoordsFromSE2(scan_w, delta_pose)
             it += 1
         return last_pose
 
@@ -179,9 +287,9 @@ class SLAM(object):
         # last_pose is a SE2
         last_pose = self._last_pose
 
+        # World scan coordinates
+        scan_w = utils.GetScanWorldCoordsFromSE2(scan, last_pose)
         while it < self.kOptMaxIters:
-            # World scan coordinates
-            scan_w = utils.GetScanWorldCoordsFromSE2(scan, last_pose)
             scan_cs, scan_rs = self._grid_map.FromMeterToCellNoRound(scan_w)
             # Hessian
             H = np.zeros((3, 3), dtype=np.float32)
@@ -249,7 +357,7 @@ class SLAM(object):
             err_metric = err_sum / opt_num
             logging.info("   error term: %s ", err_metric)
             try:
-                xi = -np.dot(np.linalg.inv(H), g)
+                xi = -np.linalg.solve(H, g)
             except np.linalg.LinAlgError as err:
                 logging.info("Hessian matrix not invertible.")
                 xi = np.zeros((3, 1), dtype=np.float32)
@@ -258,15 +366,17 @@ class SLAM(object):
             if np.abs(xi[2]) < self.kEpsOfYaw and np.linalg.norm(xi[:2]) < self.kEpsOfTrans or \
                err_metric < self.kOptStopThr:
                 break
-            last_pose = np.dot(utils.ExpFromSe2(xi), last_pose)
+            delta_pose = utils.ExpFromSe2(xi)
+            last_pose = np.dot(delta_pose, last_pose)
+            # Apply the same increment to the world scan instead of transforming it again from robot frame
+            scan_w = utils.GetScanWorldCoordsFromSE2(scan_w, delta_pose)
             it += 1
         return last_pose
 
     def Run(self):
-        scan_data = np.array(self._scans[0][0])
+        scan_data = self._scan_ranges[0]
         pose_mat = self._last_pose
-        scan_valid_idxs, scan_local_xys = self._ProcessScanToLocalCoords(
-            scan_data)
+        scan_valid_idxs, scan_local_xys = self._scan_valid_idxs[0], self._scan_local_xys[0]
         # Track from sdf map and semantic map
         scan_gt_world_xys = utils.GetScanWorldCoordsFromSE2(scan_local_xys, self._gt_poses[0])
         # Get semantic lables of the scan points
@@ -283,8 +393,8 @@ class SLAM(object):
             logging.info("t: %s", t)
             logging.info("Ground truth: %s, %s", self._gt_poses[t][0, 2], self._gt_poses[t][1, 2])
             # Get scan data in local xy coordinate
-            scan_data = np.array(self._scans[t][0])
-            scan_valid_idxs, scan_local_xys = self._ProcessScanToLocalCoords(scan_data)
+            scan_data = self._scan_ranges[t]
+            scan_valid_idxs, scan_local_xys = self._scan_valid_idxs[t], self._scan_local_xys[t]
 
             # Track from sdf map and semantic map
             scan_gt_world_xys = utils.GetScanWorldCoordsFromSE2(scan_local_xys, self._gt_poses[t])
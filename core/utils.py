@@ -1,23 +1,18 @@
+import math
 import numpy as np
 
-from scipy.linalg import expm
 
+def _MakeSE2(x, y, yaw):
+    c = math.cos(yaw)
+    s = math.sin(yaw)
+    return np.array([[c, -s, x],
+                     [s, c, y],
+                     [0, 0, 1]], dtype=np.float32)
 
 def GetSE2FromPose(pose):
     # This is NOT exponential map for se2
     x, y, yaw = pose
-    # Construct transform matrix
-    rot = np.identity(2, dtype=np.float32)
-    rot[0, 0] = float(np.cos(yaw))
-    rot[0, 1] = float(-np.sin(yaw))
-    rot[1, 0] = float(np.sin(yaw))
-    rot[1, 1] = float(np.cos(yaw))
-    # Translation vector
-    mat = np.identity(3, dtype=np.float32)
-    mat[:2, :2] = rot
-    mat[0, 2] = x
-    mat[1, 2] = y
-    return mat
+    return _MakeSE2(x, y, yaw)
 
 def LogFromSE2(mat):
     assert(mat.shape[0] == 3 and mat.shape[1] == 3)
@@ -35,12 +30,15 @@ def LogFromSE2(mat):
 
 def ExpFromSe2(xi):
     assert(xi.shape[0] == 3)
-    yaw = xi[2]
-    tmp = np.zeros((3, 3), dtype=np.float32)
-    tmp[0, 1] = -yaw
-    tmp[1, 0] = yaw
-    tmp[:2, 2] = xi[:2].reshape((2,))
-    return expm(tmp)
+    u_x, u_y, yaw = np.ravel(xi).tolist()
+    # Closed form of the left jacobian V, t = V * u
+    if abs(yaw) < 1e-6:
+        a = 1.0 - yaw * yaw / 6
+        b = yaw / 2
+    else:
+        a = math.sin(yaw) / yaw
+        b = (1 - math.cos(yaw)) / yaw
+    return _MakeSE2(a * u_x - b * u_y, b * u_x + a * u_y, yaw)
 
 def GetScanWorldCoordsFromSE2(scan, mat):
     """
@@ -49,11 +47,8 @@ def GetScanWorldCoordsFromSE2(scan, mat):
       pose - 3 by 3 matrix in SE2
     """
     assert(mat.shape[0] == 3 and mat.shape[1] == 3)
-    rot = mat[:2, :2]
-    trans = mat[:2, 2].reshape(2, 1)
     # Transform points in robot frame to world frame
-    scan_w = np.dot(rot, scan) + np.tile(trans, (1, scan.shape[1]))
-    return scan_w
+    return np.dot(mat[:2, :2], scan[:2]) + mat[:2, 2:3]
 
 def GetScanWorldCoordsFromPose(scan, pose):
     """
@@ -61,5 +56,9 @@ def GetScanWorldCoordsFromPose(scan, pose):
       scan - laser point coordinates in meters in robot frame
       pose - (x, y, yaw)
     """
-    mat = GetSE2FromPose(pose)
-    return GetScanWorldCoordsFromSE2(scan, mat)
+    # Only the 2D rotation and translation are needed, no homogeneous coordinates
+    x, y, yaw = pose
+    c = math.cos(yaw)
+    s = math.sin(yaw)
+    rot = np.array([[c, -s], [s, c]], dtype=np.float32)
+    return np.dot(rot, scan[:2]) + np.array([[x], [y]], dtype=np.float32)